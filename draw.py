@@ -1,10 +1,29 @@
+import os
 import sys
+import errno
+import weakref
 import math
-import json
+import select
+import orjson
 import time
 import serial
-import requests
 import random
+import collections
+import io
+import queue
+import threading
+import gzip
+import socket
+import ssl
+import http.client
+import urllib.request
+from urllib.parse import urlsplit, urljoin, quote
+import numpy as np
+
+try:
+    import certifi  # the CA bundle requests used; python.org macOS builds have none by default
+except ImportError:
+    certifi = None
 
 
 # Settings
@@ -12,6 +31,9 @@ PORT = "/dev/cu.usbmodem201912341"
 BAUD = 115200
 DATASET_URL = "https://storage.googleapis.com/quickdraw_dataset/full/raw/"
 SPEED_MULTIPLIER = 20  # 1.0 = real time, higher value = slower drawing
+MAX_FEED_RATE = 11500  # mm/min
+MIN_FEED_RATE = 1  # mm/min, moves are sent as whole numbers and GRBL rejects F0
+SIMPLIFY_TOLERANCE = 0.1  # mm, finer detail than this is dropped from strokes
 
 SCALE = 0.5  # Pixels to mm conversion
 BASE_MARGIN = 10  # 10 mm
@@ -21,12 +43,17 @@ Y_MAX = 600  # 840.74  # 850
 BOUNDS = 250  # 590
 PEN_UP = 0
 PEN_DOWN = -8
+RX_BUFFER_SIZE = 128  # GRBL serial receive buffer, in bytes
+MAX_REDIRECTS = 5
 
 REAL_SERIAL_PORT = True
+ECHO_GCODE = True  # print every streamed command, turn off for long or timed runs
 
 
 class Scaler:
     """Scales coordinate values given mins, maxes, and margins"""
+    __slots__ = ('smaller_scale', 'offset_x', 'offset_y', 'min_x', 'min_y', 'multiplier', 'matrix')
+
     def __init__(self, min_x, max_x, min_y, max_y, bounds=590):
         # 1. original dimensions
         x_range = max_x - min_x
@@ -34,7 +61,11 @@ class Scaler:
 
         # 2. Determine the aspect-ratio-preserving scale factor
         # Scale based on the larger dimension to ensure it fits the bounds
-        master_scale = bounds / max(x_range, y_range)
+        extent = max(x_range, y_range)
+        if extent > 0:
+            master_scale = bounds / extent
+        else:
+            master_scale = 1.0  # a single dot, there is nothing to scale
 
         # 3. Randomize the "inner" scale and position
         # 'smaller_scale' makes it potentially smaller than the full 600px
@@ -56,30 +87,94 @@ class Scaler:
         self.min_y = min_y
         self.multiplier = master_scale * self.smaller_scale
 
-    def scale(self, x, y):
-        """Applies the pre-calculated random normalization to a point."""
-        # Shift to 0, scale up, then apply the random offset
-        new_x = (x - self.min_x) * self.multiplier + self.offset_x + 5
-        new_y = - ((y - self.min_y) * self.multiplier + self.offset_y + 5)
-        return new_x, new_y
+        # 5. Precompute the normalization as one 2D affine matrix (shift to 0,
+        # scale up, apply the random offset and flip y)
+        m = self.multiplier
+        self.matrix = np.array([
+            [m, 0, self.offset_x - self.min_x * m + 5],
+            [0, -m, -(self.offset_y - self.min_y * m + 5)],
+            [0, 0, 1],
+        ])
+
+    def scale_batch(self, xs, ys):
+        """Applies the pre-calculated random normalization to arrays of points."""
+        # The matrix has no rotation or projection, so each axis is a single
+        # multiply-add with its diagonal and translation terms
+        (a, _, tx), (_, d, ty), _ = self.matrix
+        return xs * a + tx, ys * d + ty
 
 
 class MockSerialPort:
     """
-    Substitute serial port for testing when the plotter is unavailable
+    Substitute serial port for testing when the plotter is unavailable.
+    Everything written is kept in 'sent'; quiet=True skips echoing it to
+    stdout, e.g. when profiling.
     """
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.sent = io.BytesIO()
+
     def write(self, data):
-        # Print the data being sent to the "plotter"
-        print(f"[SERIAL SEND] {data.decode().strip()}")
+        self.sent.write(data)
+        if not self.quiet:
+            # Echo the data being sent to the "plotter" without decoding it,
+            # one tagged line per command even when a write carries several
+            lines = bytes(data).rstrip(b"\n").replace(b"\n", b"\n[SERIAL SEND] ")
+            sys.stdout.flush()  # keep it in order with print() output
+            sys.stdout.buffer.write(b"[SERIAL SEND] " + lines + b"\n")
 
-    @property
-    def in_waiting(self):
-        return 0  # so the loop doesn't hang waiting for a response
+    def readline(self):
+        return b"ok\r\n"  # acknowledge every command like GRBL does
 
     def close(self):
         print("[SERIAL] Connection closed.")
 
 
+# Bytes read from each port but not returned yet, shared by every reader
+# of that port so nothing read past a response is lost
+_response_buffers = weakref.WeakKeyDictionary()
+
+
+def read_response(s):
+    """
+    Read one response line from the plotter, or b"" on timeout.
+    Reads whatever has arrived on the serial file descriptor with a single
+    os.read (pyserial's readline reads one byte per call) and keeps any
+    leftover for the next call. Ports without a selectable descriptor,
+    like MockSerialPort or pyserial on Windows, fall back to readline().
+    """
+    try:
+        fd = s.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return s.readline()
+
+    inbuf = _response_buffers.setdefault(s, bytearray())
+    deadline = None if s.timeout is None else time.monotonic() + s.timeout
+    while True:
+        nl = inbuf.find(b"\n")
+        if nl >= 0:
+            line = bytes(inbuf[:nl + 1])
+            del inbuf[:nl + 1]
+            return line
+
+        remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+        ready, _, _ = select.select([fd], [], [], remaining)
+        if not ready:
+            return b""
+        try:
+            data = os.read(fd, 256)
+        except OSError as e:
+            # pyserial opens the port non-blocking: like its own read(),
+            # retry after a spurious wakeup instead of failing
+            if e.errno in (errno.EAGAIN, errno.EALREADY, errno.EWOULDBLOCK,
+                           errno.EINPROGRESS, errno.EINTR):
+                continue
+            raise serial.SerialException(f"read failed: {e}")
+        if not data:
+            raise serial.SerialException("device reports readiness to read but returned no data")
+        inbuf += data
+
+
 def send(s, cmd):
     """
     Execute gcode command to iDraw plotter
@@ -87,79 +182,197 @@ def send(s, cmd):
     print(">>", cmd)
     s.write((cmd + "\n").encode())
 
-    if s is not MockSerialPort:
-        # Wait for the plotter to respond with 'ok'
-        while True:
-            line = s.readline().decode().strip()
-            if line:
-                print(f"[{line}]") # This will show 'ok' or 'error'
-            if "ok" in line.lower():
-                break
-            if "error" in line.lower() or "alarm" in line.lower():
-                print(f"!!! MACHINE ERROR: {line}")
-                break
-    else:
-        time.sleep(0.05)
-        while s.in_waiting:
-            print(s.readline().decode().strip())
+    # Wait for the plotter to respond with 'ok' (MockSerialPort answers
+    # like the real plotter, so both take the same path)
+    while True:
+        line = read_response(s).decode().strip()
+        if line:
+            print(f"[{line}]") # This will show 'ok' or 'error'
+        if "ok" in line.lower():
+            break
+        if "error" in line.lower() or "alarm" in line.lower():
+            print(f"!!! MACHINE ERROR: {line}")
+            break
 
 
-def plot_drawing(s, drawing_data):
+class GcodeStream:
+    """
+    Streams gcode to the plotter using GRBL's character-counting protocol:
+    lines are sent as long as every unacknowledged byte still fits in the
+    plotter's receive buffer, instead of waiting for an 'ok' after each one
+    """
+    def __init__(self, s):
+        self.s = s
+        self.pending = collections.deque()  # byte length of each unacknowledged line
+        self.in_flight = 0
+        self.outbuf = bytearray()  # lines queued but not yet written to the port
+
+    def write(self, cmd):
+        """
+        Queue a command (bytes, without the newline), blocking for
+        acknowledgements only when the buffer is full
+        """
+        if ECHO_GCODE:
+            print(">>", cmd.decode())
+        size = len(cmd) + 1
+        while self.pending and self.in_flight + size >= RX_BUFFER_SIZE:
+            self._wait_ok()
+        # Append straight into the reused buffer, no per-line encode or copy
+        self.outbuf += cmd
+        self.outbuf.append(0x0A)  # newline
+        self.pending.append(size)
+        self.in_flight += size
+
+    def flush(self):
+        """Wait until the plotter has acknowledged every queued command"""
+        while self.pending:
+            self._wait_ok()
+
+    def _wait_ok(self):
+        """Write out queued lines, then consume one response from the plotter"""
+        if self.outbuf:
+            self.s.write(self.outbuf)  # one write for every line that fits
+            self.outbuf.clear()
+
+        line = read_response(self.s).decode().strip()
+        if not line:
+            return
+        print(f"[{line}]") # This will show 'ok' or 'error'
+        if "error" in line.lower() or "alarm" in line.lower():
+            print(f"!!! MACHINE ERROR: {line}")
+        # GRBL answers every line with exactly one 'ok' or 'error'
+        if "ok" in line.lower() or "error" in line.lower():
+            self.in_flight -= self.pending.popleft()
+
+
+def _simplify_stroke(sx, sy, tolerance):
+    """
+    Ramer-Douglas-Peucker simplification of a stroke.
+    Returns a mask of the points to keep so that no dropped point lies
+    further than 'tolerance' from the simplified line.
     """
-    Docstring for plot_drawing
+    sx = np.asarray(sx, dtype=np.float64)
+    sy = np.asarray(sy, dtype=np.float64)
+    n = len(sx)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        # Distance of every point in between to the segment first -> last
+        dx = sx[last] - sx[first]
+        dy = sy[last] - sy[first]
+        px = sx[first + 1:last] - sx[first]
+        py = sy[first + 1:last] - sy[first]
+        length = math.hypot(dx, dy)  # scalar, skip the ufunc machinery
+        if length > 0:
+            # Project onto the segment and clamp to its ends, so points that
+            # overshoot past first or last (turnarounds, retraces) still count
+            t = np.clip((px * dx + py * dy) / (length * length), 0, 1)
+            distances = np.hypot(px - t * dx, py - t * dy)
+        else:
+            distances = np.hypot(px, py)  # closed loop, measure from the endpoint
+
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            mid = first + 1 + i
+            keep[mid] = True
+            stack.append((first, mid))
+            stack.append((mid, last))
+    return keep
+
+
+def _transform_stroke(sx, sy, ts, spd, vmin, vmax, tolerance):
+    """
+    Simplify one scaled stroke and compute the feed rate of every move.
+    Returns (sx, sy, feed, targets): the simplified stroke, then the feed
+    rate of each move to send and the index of the point it moves to.
+    """
+    # Drop points the plotter can't resolve; the kept points keep their own
+    # timestamps so each longer move still takes as long as it did originally
+    keep = _simplify_stroke(sx, sy, tolerance)
+    sx, sy, ts = sx[keep], sy[keep], ts[keep]
+
+    # Skip points with no delay first, so velocities are only computed for
+    # the moves that can be sent
+    dt = np.diff(ts) / 1000.0
+    targets = np.flatnonzero(dt > 0) + 1
+    velocities = np.hypot(sx[targets] - sx[targets - 1],
+                          sy[targets] - sy[targets - 1]) / dt[targets - 1]
+
+    # ... then points with no movement
+    moving = velocities > 0
+    targets, velocities = targets[moving], velocities[moving]
+    feed = np.clip(velocities * spd, vmin, vmax)
+    return sx, sy, feed, targets
+
+
+def prepare_drawing(drawing_data):
+    """
+    Scale and simplify a Quick, Draw! drawing and return its gcode commands
     """
     # 'drawing' is a list of strokes: [[x1, x2, ...], [y1, y2, ...]]
     strokes = drawing_data['drawing']
 
-    min_x = math.inf
-    max_x = -math.inf
-    min_y = math.inf
-    max_y = -math.inf
-    for stroke in strokes:
-        min_x = min(min_x, min(stroke[0]))
-        max_x = max(max_x, max(stroke[0]))
-        min_y = min(min_y, min(stroke[1]))
-        max_y = max(max_y, max(stroke[1]))
+    # Convert every stroke to a (3, n) array of [x, y, t] rows once, for both
+    # the bounding box and the transformation below
+    strokes = [np.asarray(stroke, dtype=np.float64) for stroke in strokes]
+
+    # Bounding box of the whole drawing, one min and one max pass over all points
+    all_points = np.concatenate([stroke[:2] for stroke in strokes], axis=1)
+    (min_x, min_y), (max_x, max_y) = all_points.min(axis=1).tolist(), all_points.max(axis=1).tolist()
     scaler = Scaler(min_x, max_x, min_y, max_y, bounds=BOUNDS)
 
+    # Bind the hot names to locals once instead of looking them up per stroke
+    scale_batch = scaler.scale_batch
+    spd = SPEED_MULTIPLIER
+    gcode = []
+    emit = gcode.append
+    # Fixed commands are encoded once; every command is built as bytes
+    pen_up = f"G1 Z{PEN_UP} F7000".encode()
+    pen_down = f"G1 Z{PEN_DOWN} F7000".encode()
+    travel = b"G0 X%.3f Y%.3f F" + str(MAX_FEED_RATE).encode()
+
     for stroke in strokes:
-        x_coords = stroke[0] # pixel x
-        y_coords = stroke[1] # pixel y
-        timestamps = stroke[2] # in cumulative milliseconds since the first stroke
+        xs = stroke[0] # pixel x
+        ys = stroke[1] # pixel y
+        ts = stroke[2] # in cumulative milliseconds since the first stroke
+
+        sx, sy = scale_batch(xs, ys)
+        sx, sy, clamped_velocities, targets = _transform_stroke(
+            sx, sy, ts, spd, MIN_FEED_RATE, MAX_FEED_RATE, SIMPLIFY_TOLERANCE)
 
         # Step 1. move plotter to start of stroke
-        send(s, f"G1 Z{PEN_UP} F7000")  # pen up
-        start_x, start_y = scaler.scale(x_coords[0], y_coords[0])
-        send(s, f"G0 X{start_x:.3f} Y{start_y:.3f} F11500")  # move to start of stroke
+        emit(pen_up)
+        emit(travel % (sx[0], sy[0]))  # move to start of stroke
 
         # Step 2. perform the stroke
-        send(s, f"G1 Z{PEN_DOWN} F7000")  # pen down
-
-        for i in range(1, len(x_coords)):
-            # Calculate timestamp delay between these two points
-            delta_ms = timestamps[i] - timestamps[i-1]
-            delay_seconds = delta_ms / 1000.0
+        emit(pen_down)
 
-            if delay_seconds <= 0:
-                continue
+        # tolist() so the loop iterates plain Python floats rather than NumPy scalars
+        points = zip(sx[targets].tolist(), sy[targets].tolist(), clamped_velocities.tolist())
+        # %-formatting with a fixed template is cheaper than an f-string per point.
+        # Runs of nearly collinear points were already merged into single
+        # moves by _simplify_stroke, so every point left is a real segment
+        gcode.extend([b"G1 X%.3f Y%.3f F%.0f" % point for point in points])
 
-            x, y = scaler.scale(x_coords[i], y_coords[i])
-            x_prior, y_prior = scaler.scale(x_coords[i-1], y_coords[i-1])
-            velocity = math.sqrt(((x - x_prior) ** 2) + ((y - y_prior) ** 2)) / delay_seconds
-            #delta_x = (x_coords[i] - x_coords[i-1]) * SCALE
-            #delta_y = (y_coords[i] - y_coords[i-1]) * SCALE
-            #velocity = math.sqrt((delta_x ** 2) + (delta_y ** 2)) / delay_seconds
+    emit(pen_up)
+    return gcode
 
-            if velocity <= 0:
-                continue
 
-            # Send the move command
-            # x = x_coords[i] * SCALE
-            # y = y_coords[i] * -SCALE
-            clamped_velocity = min(velocity * SPEED_MULTIPLIER, 11500)
-            send(s, f"G1 X{x:.3f} Y{y:.3f} F{clamped_velocity}")
-
-    send(s, f"G1 Z{PEN_UP} F7000") # pen up
+def plot_drawing(s, gcode):
+    """
+    Stream the gcode commands of a prepared drawing to the plotter
+    """
+    stream = GcodeStream(s)
+    write = stream.write
+    for cmd in gcode:
+        write(cmd)
+    stream.flush()
 
 
 def get_ndjson(filename):
@@ -169,32 +382,140 @@ def get_ndjson(filename):
     return DATASET_URL + filename + ".ndjson"
 
 
-def stream_and_plot(s, url, limit=1):
+def _connect(parts):
     """
-    Stream ndjson from the web and plots the first 'limit' drawings.
+    Return an unopened http.client connection for a split url, verifying
+    TLS with certifi's CA bundle when it is installed and tunnelling through
+    the HTTPS proxy from the environment (HTTPS_PROXY / NO_PROXY) if set
+    """
+    # waits 5s to connect and 5s for every read after that
+    if parts.scheme == "http":
+        return http.client.HTTPConnection(parts.netloc, timeout=5)
+
+    cafile = certifi.where() if certifi is not None else None
+    context = ssl.create_default_context(cafile=cafile)
+    proxy = urllib.request.getproxies().get("https")
+    if proxy and not urllib.request.proxy_bypass(parts.hostname):
+        # Proxy authentication is not supported
+        proxy = urlsplit(proxy if "://" in proxy else "http://" + proxy)
+        conn = http.client.HTTPSConnection(proxy.hostname, proxy.port or 8080,
+                                           timeout=5, context=context)
+        conn.set_tunnel(parts.netloc)
+        return conn
+    return http.client.HTTPSConnection(parts.netloc, timeout=5, context=context)
+
+
+def open_ndjson(url):
+    """
+    Open a streaming connection to an ndjson url, following redirects.
+    Returns (connection, body): the body is a file object, gunzipped on the
+    fly if the server compresses it; close the connection when done.
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        # '%' is safe so already-encoded redirect targets aren't encoded twice
+        target = quote(parts.path or "/", safe="/%") + ("?" + parts.query if parts.query else "")
+        try:
+            conn = _connect(parts)
+            conn.request("GET", target, headers={"Accept-Encoding": "gzip"})
+            response = conn.getresponse()
+        except socket.timeout:
+            sys.exit("Error: The connection timed out. Please check your internet.")
+        except (OSError, http.client.HTTPException) as e:
+            sys.exit(f"Error: A network error occurred: {e}")
+
+        location = response.getheader("Location")
+        if response.status in (301, 302, 303, 307, 308) and location:
+            conn.close()
+            url = urljoin(url, location)
+            continue
+
+        if response.status != 200: # Check if URL is valid (404, etc)
+            conn.close()
+            sys.exit(f"Error: A network error occurred: {response.status} {response.reason} for url: {url}")
+
+        if response.getheader("Content-Encoding") == "gzip":
+            return conn, gzip.GzipFile(fileobj=response)
+        return conn, response
+
+    sys.exit(f"Error: A network error occurred: too many redirects for url: {url}")
+
+
+def iter_ndjson_lines(chunks):
+    """
+    Split a stream of raw byte chunks into ndjson lines, skipping blank ones
+    """
+    buf = bytearray()
+    for chunk in chunks:
+        buf.extend(chunk)
+        start = 0
+        while True:
+            nl = buf.find(b"\n", start)
+            if nl < 0:
+                break
+            line = bytes(buf[start:nl])
+            if line.strip():  # also skips the '\r' left by CRLF line endings
+                yield line
+            start = nl + 1
+        del buf[:start]  # keep only the incomplete last line
+    if buf.strip():
+        yield bytes(buf)
+
+
+def fetch_drawings(url, limit, drawings):
+    """
+    Producer thread: stream, parse and prepare the first 'limit' drawings
+    onto the 'drawings' queue as (word, gcode), then None when done.
+    Any exception (including sys.exit) is put on the queue instead.
     """
     try:
-        # waits 5s to connect and 5s for the first byte
-        # stream=True keeps connection open without downloading the whole file
-        response = requests.get(url, stream=True, timeout=5)
-        response.raise_for_status() # Check if URL is valid (404, etc)
-    except requests.exceptions.Timeout:
-        sys.exit("Error: The connection timed out. Please check your internet.")
-    except requests.exceptions.RequestException as e:
-        sys.exit(f"Error: A network error occurred: {e}")
+        # the body is read as it arrives, without downloading the whole file
+        conn, body = open_ndjson(url)
+        try:
+            count = 0
+            # read large raw chunks and split the Newline Delimited (ndjson) lines ourselves
+            chunks = iter(lambda: body.read(65536), b"")
+            for line in iter_ndjson_lines(chunks):
+                if count >= limit:
+                    break
+                drawing_data = orjson.loads(line)
+                drawings.put((drawing_data['word'], prepare_drawing(drawing_data)))
+                count += 1
+        finally:
+            conn.close() # stop the download once 'limit' drawings are read
+    except BaseException as e:
+        drawings.put(e)
+        return
+    drawings.put(None)
+
+
+def prefetch_drawings(url, limit=1):
+    """
+    Start downloading and preparing the first 'limit' drawings from url on
+    a background thread; returns the queue they arrive on
+    """
+    drawings = queue.Queue(maxsize=2)  # at most two drawings ready ahead of the plotter
+    threading.Thread(target=fetch_drawings, args=(url, limit, drawings), daemon=True).start()
+    return drawings
 
+
+def plot_drawings(s, drawings):
+    """
+    Plot every drawing from a prefetch_drawings queue as it becomes ready
+    """
     count = 0
-    # iter_lines() handles the Newline Delimited (ndjson) format
-    for line in response.iter_lines():
-        if line and count < limit:
-            drawing_data = json.loads(line)
-            print(f"\n--- Starting Drawing {count+1}: {drawing_data['word']} ---")
+    while True:
+        item = drawings.get()
+        if item is None:
+            break
+        if isinstance(item, BaseException):
+            raise item # e.g. the network errors from open_ndjson
+        word, gcode = item
+        print(f"\n--- Starting Drawing {count+1}: {word} ---")
 
-            plot_drawing(s, drawing_data)
+        plot_drawing(s, gcode)
 
-            count += 1
-        elif count >= limit:
-            break
+        count += 1
 
 
 def reset_plotter(s):
@@ -217,6 +538,11 @@ def main():
     """
     Docstring for main
     """
+    # Start fetching the drawings right away so the download and parsing
+    # overlap the plotter reset and setup below
+    # drawings = prefetch_drawings(get_ndjson("The Eiffel Tower"), 1)
+    drawings = prefetch_drawings(get_ndjson("dragon"), 1)
+
     try:
         s = serial.Serial(PORT, BAUD, timeout=1)
         time.sleep(2)
@@ -239,8 +565,7 @@ def main():
     send(s, "G10 L20 P1 X0 Y0 Z0")
 
     # Plot from ndjson
-    # stream_and_plot(s, get_ndjson("The Eiffel Tower"), 1)
-    stream_and_plot(s, get_ndjson("dragon"), 1)
+    plot_drawings(s, drawings)
 
     #send(s, "G1 X0 Y-840 F10000")
     #for i in range(50):